@@ -1,20 +1,22 @@
 #!/usr/bin/env python3
 
-from typing import Any
+from typing import Any, Iterator, Optional
 from typing_extensions import Self
+from contextlib import contextmanager
 import serial
+import struct
 import time
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(levelname)s : %(module)s : %(funcName)s : %(message)s')
+logger = logging.getLogger(__name__)
 
-S_CHAR = b'S'
-P_CHAR = b'P'
-R_CHAR = b'R' 
-W_CHAR = b'W'
-I_CHAR = b'I'
-O_CHAR = b'O'
-Z_CHAR = b'Z'
+S_CHAR = 0x53
+P_CHAR = 0x50
+R_CHAR = 0x52
+W_CHAR = 0x57
+I_CHAR = 0x49
+O_CHAR = 0x4F
+Z_CHAR = 0x5A
 
 BRG0      = 0x00
 BRG1      = 0x01
@@ -28,21 +30,38 @@ I2CCLKH   = 0x08
 I2CTO     = 0x09
 I2CSTAT   = 0x0A
 
+BRG_CLOCK        = 7.3728e6
+DEFAULT_BAUDRATE = 9600
+MIN_BAUDRATE     = BRG_CLOCK / (16 + 0xFFFF)
+MAX_BAUDRATE     = BRG_CLOCK / 16
+MIN_TIMEOUT      = 0.05
+MAX_FRAME_SIZE   = 0xFF + 7
+
+_U16LE = struct.Struct('<H')
+
 class SC18IM700:
     """ USBシリアル-I2C変換（SC18IM700）の制御ドライバ """
 
-    def __init__(self, port: Any) -> None:
+    def __init__(self, port: Any, baudrate: int = 115200) -> None:
         """ インスタンスを初期化する
         """
+        self._target_brg: int = self.baudrate_to_brg(baudrate)
+        self.target_baudrate: int = baudrate
+        self._io_state_cache: Optional[int] = None
+        self._port_conf_cache: Optional[int] = None
+        self._gpio_deferred: bool = False
+        self._gpio_dirty: bool = False
         self.serial: serial.Serial = serial.Serial(port)
-        self.serial.baudrate = 9600
+        self.serial.baudrate = DEFAULT_BAUDRATE
         self.serial.bytesize = serial.EIGHTBITS
         self.serial.parity = serial.PARITY_NONE
         self.serial.stopbits = serial.STOPBITS_ONE
-        self.serial.timeout = 0.5
+        self.serial.inter_byte_timeout = None
+        self._update_timeout()
         if self.serial.is_open:
             self.serial.reset_input_buffer()
             self.serial.reset_output_buffer()
+            self._sync_baudrate()
 
     def open(self) -> None:
         """ シリアルポートを開く
@@ -51,6 +70,30 @@ class SC18IM700:
             self.serial.open()
             self.serial.reset_input_buffer()
             self.serial.reset_output_buffer()
+            self._sync_baudrate()
+
+    def _update_timeout(self) -> None:
+        """ ボーレートから最大フレームの転送時間を求め、タイムアウトを設定する
+        """
+        frame_time = (MAX_FRAME_SIZE * 10) / self.serial.baudrate
+        self.serial.timeout = max(MIN_TIMEOUT, 2 * frame_time)
+
+    def _sync_baudrate(self) -> None:
+        """ デバイスのボーレートを目標値に合わせる
+        """
+        # 目標値で応答がなければ、電源投入直後の DEFAULT_BAUDRATE で問い合わせる
+        for probe in dict.fromkeys((self.target_baudrate, DEFAULT_BAUDRATE)):
+            self.serial.baudrate = probe
+            self._update_timeout()
+            self.serial.reset_input_buffer()
+            try:
+                current = self._read_brg()
+            except RuntimeError:
+                continue
+            if current != self._target_brg:
+                self.change_baudrate(self.target_baudrate)
+            return
+        raise RuntimeError
 
     def close(self) -> None:
         """ シリアルポートを閉じる
@@ -74,91 +117,165 @@ class SC18IM700:
     def read(self, size: int = 1) -> bytes:
         """ シリアルポートからデータを読み込む
         """
+        return self._read_exact(size)
+
+    def _read_exact(self, size: int) -> bytes:
+        """ 指定サイズのデータが揃うまでシリアルポートから読み込む
+        """
+        timeout = self.serial.timeout
+        deadline = time.monotonic() + timeout
         data = self.serial.read(size)
         if len(data) < size:
-            raise RuntimeError
+            try:
+                while len(data) < size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RuntimeError
+                    self.serial.timeout = remaining
+                    data += self.serial.read(size - len(data))
+            finally:
+                self.serial.timeout = timeout
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', data.hex(' '))
         return data
 
     def write(self, data: bytes) -> None:
         """ シリアルポートへデータを書き込む
         """
         self.serial.write(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', data.hex(' '))
 
-    @classmethod
-    def i2c_read_addr(cls, i2c_addr: int) -> int:
+    def flush(self) -> None:
+        """ 書き込んだデータの送信完了を待つ
+        """
+        self.serial.flush()
+
+    @staticmethod
+    def i2c_read_addr(i2c_addr: int) -> int:
         """ I2C読み込みアドレスを返す
         """
-        if (i2c_addr < 0x00) or (0x7F < i2c_addr):
+        if not (0x00 <= i2c_addr <= 0x7F):
             raise ValueError
-        return int((i2c_addr << 1) | 0x01)
+        return (i2c_addr << 1) | 0x01
 
-    @classmethod
-    def i2c_write_addr(cls, i2c_addr: int) -> int:
+    @staticmethod
+    def i2c_write_addr(i2c_addr: int) -> int:
         """ I2C書き込みアドレスを返す
         """
-        if (i2c_addr < 0x00) or (0x7F  < i2c_addr):
+        if not (0x00 <= i2c_addr <= 0x7F):
             raise ValueError
-        return int((i2c_addr << 1) & 0xFE)
+        return (i2c_addr << 1) & 0xFE
 
     def read_i2c(self, i2c_addr: int, size: int) -> bytes:
         """ I2Cバスからデータを読み込む
         """
         i2c_read_addr =self.i2c_read_addr(i2c_addr)
-        if (size < 0x00) or (0xFF < size):
+        if not (0x00 <= size <= 0xFF):
             raise ValueError
-        payload = bytes([i2c_read_addr, size])
-        tx_data = S_CHAR + payload + P_CHAR
+        tx_data = bytes((S_CHAR, i2c_read_addr, size, P_CHAR))
         self.write(tx_data)
-        logging.debug('%s', self.bytes_to_str(tx_data))
-        time.sleep(10/1000)
         rx_data = self.read(size)
-        logging.debug('%s', self.bytes_to_str(rx_data))
         return rx_data
 
-    def write_i2c(self, i2c_addr: int, data: bytes) -> None:
-        """ I2Cバスへデータを書き込む
+    @classmethod
+    def i2c_write_frame(cls, i2c_addr: int, data: bytes) -> bytes:
+        """ I2Cバスへの書き込みフレームを返す
         """
-        i2c_write_addr = self.i2c_write_addr(i2c_addr)
+        i2c_write_addr = cls.i2c_write_addr(i2c_addr)
         size = len(data)
-        if (size < 0x00) or (0xFF < size):
+        if not (0x00 <= size <= 0xFF):
             raise ValueError
-        payload = bytes([i2c_write_addr, size]) + bytes(data)
-        tx_data = S_CHAR + payload + P_CHAR
+        tx_data = bytearray(size + 4)
+        tx_data[0] = S_CHAR
+        tx_data[1] = i2c_write_addr
+        tx_data[2] = size
+        tx_data[3:-1] = data
+        tx_data[-1] = P_CHAR
+        return bytes(tx_data)
+
+    @classmethod
+    def i2c_write_read_frame(cls, i2c_addr: int, data: bytes, size: int) -> bytes:
+        """ I2Cバスへの書き込みとリピートスタートでの読み込みを行うフレームを返す
+        """
+        i2c_write_addr = cls.i2c_write_addr(i2c_addr)
+        i2c_read_addr = cls.i2c_read_addr(i2c_addr)
+        wsize = len(data)
+        if not (0x00 <= wsize <= 0xFF):
+            raise ValueError
+        if not (0x00 <= size <= 0xFF):
+            raise ValueError
+        tx_data = bytearray(wsize + 7)
+        tx_data[0] = S_CHAR
+        tx_data[1] = i2c_write_addr
+        tx_data[2] = wsize
+        tx_data[3:wsize + 3] = data
+        tx_data[wsize + 3] = S_CHAR
+        tx_data[wsize + 4] = i2c_read_addr
+        tx_data[wsize + 5] = size
+        tx_data[-1] = P_CHAR
+        return bytes(tx_data)
+
+    def write_raw(self, tx_data: bytes) -> None:
+        """ 組み立て済みのフレームを書き込む
+        """
+        self.write(tx_data)
+
+    def write_read_raw(self, tx_data: bytes, size: int) -> bytes:
+        """ 組み立て済みのフレームを書き込み、応答データを読み込む
+        """
         self.write(tx_data)
-        logging.debug('%s', self.bytes_to_str(tx_data))
+        rx_data = self.read(size)
+        return rx_data
+
+    def write_i2c(self, i2c_addr: int, data: bytes) -> None:
+        """ I2Cバスへデータを書き込む
+        """
+        tx_data = self.i2c_write_frame(i2c_addr, data)
+        self.write_raw(tx_data)
+
+    def write_read_i2c(self, i2c_addr: int, data: bytes, size: int) -> bytes:
+        """ I2Cバスへデータを書き込み、リピートスタートで続けてデータを読み込む
+        """
+        tx_data = self.i2c_write_read_frame(i2c_addr, data, size)
+        return self.write_read_raw(tx_data, size)
 
     def read_reg(self, reg_addr: bytes) -> None:
         """ 内部レジスタから値を読み込む
         """
         size = len(reg_addr)
-        if (size < 0x00) or (0xFF < size):
+        if not (0x00 <= size <= 0xFF):
             raise ValueError
-        payload = bytes(reg_addr)
-        tx_data = R_CHAR + payload + P_CHAR
+        tx_data = bytearray(size + 2)
+        tx_data[0] = R_CHAR
+        tx_data[1:-1] = reg_addr
+        tx_data[-1] = P_CHAR
         self.write(tx_data)
-        logging.debug('%s', self.bytes_to_str(tx_data))
-        time.sleep(10/1000)
         rx_data = self.read(size)
-        logging.debug('%s', self.bytes_to_str(rx_data))
         return rx_data
 
     def write_reg(self, reg_addr: bytes, data: bytes) -> None:
         """ 内部レジスタへ値を書き込む
         """
-        payload = b''.join(bytes([r, d]) for r, d in zip(reg_addr, data))
-        tx_data = W_CHAR + payload + P_CHAR
+        size = min(len(reg_addr), len(data))
+        tx_data = bytearray(size * 2 + 2)
+        tx_data[0] = W_CHAR
+        tx_data[1:-1:2] = reg_addr[:size]
+        tx_data[2:-1:2] = data[:size]
+        tx_data[-1] = P_CHAR
         self.write(tx_data)
-        logging.debug('%s', self.bytes_to_str(tx_data))
+        if (PORTCONF1 in reg_addr[:size]) or (PORTCONF2 in reg_addr[:size]):
+            self._port_conf_cache = None
+        if IOSTATE in reg_addr[:size]:
+            self._io_state_cache = None
 
     def read_gpio(self) -> bytes:
         """ GPIOから値を読み込む
         """
-        tx_data = I_CHAR + P_CHAR
+        tx_data = bytes((I_CHAR, P_CHAR))
         self.write(tx_data)
-        logging.debug('%s', self.bytes_to_str(tx_data))
-        time.sleep(10/1000)
         rx_data = self.read()
-        logging.debug('%s', self.bytes_to_str(rx_data))
+        self._io_state_cache = rx_data[0]
         return rx_data
 
     def write_gpio(self, data: bytes) -> None:
@@ -166,39 +283,71 @@ class SC18IM700:
         """
         if len(data) != 1:
             raise ValueError
-        payload = data
-        tx_data = O_CHAR + payload + P_CHAR
+        tx_data = bytes((O_CHAR, data[0], P_CHAR))
         self.write(tx_data)
-        logging.debug('%s', self.bytes_to_str(tx_data))
+        self._io_state_cache = data[0]
+
+    @contextmanager
+    def gpio_transaction(self) -> Iterator[None]:
+        """ GPIOを一度だけ読み込み、ブロック内の入出力をまとめて一度で書き込む
+        """
+        self.read_gpio()
+        self._gpio_deferred = True
+        self._gpio_dirty = False
+        try:
+            yield
+        except BaseException:
+            self._io_state_cache = None
+            self._gpio_dirty = False
+            raise
+        finally:
+            self._gpio_deferred = False
+        if self._gpio_dirty:
+            self._gpio_dirty = False
+            self.write_gpio(bytes([self._io_state_cache]))
 
     @property
     def baudrate(self) -> int:
         """ シリアルポートのボーレートを返す
         """
+        brg = self._read_brg()
+        value = int(BRG_CLOCK / (16 + brg))
+        return value
+
+    def _read_brg(self) -> int:
+        """ ボーレート設定レジスタ（BRG0/BRG1）の値を返す
+        """
         reg_addr = bytes([BRG0, BRG1])
         rdata = self.read_reg(reg_addr)
-        brg = int.from_bytes(rdata, byteorder='little')
-        value = int(7.3728e6 / (16 + brg))
-        return value
+        return _U16LE.unpack(rdata)[0]
+
+    @staticmethod
+    def baudrate_to_brg(value: int) -> int:
+        """ ボーレートに対応するボーレート設定レジスタの値を返す
+        """
+        if not (MIN_BAUDRATE <= value <= MAX_BAUDRATE):
+            raise ValueError
+        return int((BRG_CLOCK / value) - 16)
 
     def change_baudrate(self, value: int) -> None:
         """ シリアルポートのボーレートを変更する
         """
+        # BRG0/BRG1 は同じ W コマンドで続けて書き込む必要がある
+        # 設定は揮発性のため、電源を再投入すると DEFAULT_BAUDRATE に戻る
         reg_addr = bytes([BRG0, BRG1])
-        brg = int((7.3728e6 / value) - 16)
-        wdata = brg.to_bytes(len(reg_addr), byteorder='little')
+        brg = self.baudrate_to_brg(value)
+        wdata = _U16LE.pack(brg)
         self.write_reg(reg_addr, wdata)
         time.sleep(1)
         self.serial.baudrate = value
+        self._update_timeout()
 
     def get_port_conf(self, port: int) -> int:
         """ GPIOポートの機能を返す
         """
-        if (port < 0) or (7 < port):
+        if not (0 <= port <= 7):
             raise ValueError
-        reg_addr = bytes([PORTCONF1, PORTCONF2])
-        rdata = self.read_reg(reg_addr)
-        port_conf = int.from_bytes(rdata, byteorder='little')
+        port_conf = self._read_port_conf()
         shift = port * 2
         mask = 0b11 << shift
         value = int((port_conf & mask) >> shift)
@@ -207,26 +356,56 @@ class SC18IM700:
     def set_port_conf(self, port: int, value: int) -> None:
         """ GPIOポートの機能を設定する
         """
-        if (port < 0) or (7 < port):
+        if not (0 <= port <= 7):
             raise ValueError
-        if (value < 0) or (3 < value):
+        if not (0 <= value <= 3):
             raise ValueError
         reg_addr = bytes([PORTCONF1, PORTCONF2])
-        rdata = self.read_reg(reg_addr)
-        port_conf = int.from_bytes(rdata, byteorder='little')
+        port_conf = self._read_port_conf()
         shift = port * 2
         mask = 0b11 << shift
         port_conf = int((port_conf & ~mask) | (value << shift))
-        wdata = port_conf.to_bytes(len(reg_addr), byteorder='little')
+        wdata = _U16LE.pack(port_conf)
+        self.write_reg(reg_addr, wdata)
+        self._port_conf_cache = port_conf
+
+    def set_port_confs(self, port_mask: int, values: int) -> None:
+        """ 複数のGPIOポートの機能をまとめて設定する（values はポートごとに2ビットずつ並べた値）
+        """
+        if not (0x00 <= port_mask <= 0xFF):
+            raise ValueError
+        if not (0x0000 <= values <= 0xFFFF):
+            raise ValueError
+        conf_mask = 0
+        for port in range(8):
+            if port_mask & (0b1 << port):
+                conf_mask |= 0b11 << (port * 2)
+        if conf_mask == 0xFFFF:
+            port_conf = values
+        else:
+            port_conf = (self._read_port_conf() & ~conf_mask) | (values & conf_mask)
+        reg_addr = bytes([PORTCONF1, PORTCONF2])
+        wdata = _U16LE.pack(port_conf)
         self.write_reg(reg_addr, wdata)
+        self._port_conf_cache = port_conf
+
+    def _read_port_conf(self) -> int:
+        """ GPIOポートの機能設定を返す（キャッシュがあれば読み込みを省略する）
+        """
+        if self._port_conf_cache is None:
+            reg_addr = bytes([PORTCONF1, PORTCONF2])
+            rdata = self.read_reg(reg_addr)
+            self._port_conf_cache = _U16LE.unpack(rdata)[0]
+        return self._port_conf_cache
 
     def port_in(self, port: int) -> bool:
         """ GPIOポートから値を入力する
         """
-        if (port < 0) or (7 < port):
+        if not (0 <= port <= 7):
             raise ValueError
-        rdata = self.read_gpio()
-        io_state = int.from_bytes(rdata, byteorder='little')
+        if not self._gpio_deferred:
+            self.read_gpio()
+        io_state = self._io_state_cache
         shift = port * 1
         mask = 0b1 << shift
         value = bool((io_state & mask) >> shift)
@@ -235,33 +414,57 @@ class SC18IM700:
     def port_out(self, port: int, value: bool) -> None:
         """ GPIOポートへ値を出力する
         """
-        if (port < 0) or (7 < port):
+        if not (0 <= port <= 7):
             raise ValueError
-        rdata = self.read_gpio()
-        io_state = int.from_bytes(rdata, byteorder='little')
+        if self._io_state_cache is None:
+            self.read_gpio()
+        io_state = self._io_state_cache
         shift = port * 1
         mask = 0b1 << shift
         io_state = int((io_state & ~mask) | (int(value) << shift))
-        wdata = io_state.to_bytes(1, byteorder='little')
+        if self._gpio_deferred:
+            self._io_state_cache = io_state
+            self._gpio_dirty = True
+            return
+        wdata = bytes((io_state,))
         self.write_gpio(wdata)
 
+    def set_ports(self, mask: int, values: int) -> None:
+        """ 複数のGPIOポートへまとめて値を出力する（mask で指定したビットのみ更新する）
+        """
+        if not (0x00 <= mask <= 0xFF):
+            raise ValueError
+        if not (0x00 <= values <= 0xFF):
+            raise ValueError
+        if mask == 0xFF:
+            io_state = values
+        else:
+            if self._io_state_cache is None:
+                self.read_gpio()
+            io_state = (self._io_state_cache & ~mask) | (values & mask)
+        if self._gpio_deferred:
+            self._io_state_cache = io_state
+            self._gpio_dirty = True
+            return
+        self.write_gpio(bytes((io_state,)))
+
     def get_i2c_master_addr(self) -> int:
         """ デバイスのI2Cアドレスを返す
         """
         reg_addr = bytes([I2CADR])
         rdata = self.read_reg(reg_addr)
-        i2c_addr = int.from_bytes(rdata, byteorder='little')
+        i2c_addr = rdata[0]
         value = int((i2c_addr >> 1) & 0x7F)
         return value
 
     def set_i2c_master_addr(self, value: int) -> None:
         """ デバイスのI2Cアドレスを設定する
         """
-        if (value < 0x00) or (0x7F < value):
+        if not (0x00 <= value <= 0x7F):
             raise ValueError
         reg_addr = bytes([I2CADR])
         i2c_addr = int((value << 1) & 0xFE)
-        wdata = i2c_addr.to_bytes(1, byteorder='little')
+        wdata = bytes((i2c_addr,))
         self.write_reg(reg_addr, wdata)
 
     def get_i2c_status(self) -> int:
@@ -269,7 +472,7 @@ class SC18IM700:
         """
         reg_addr = bytes([I2CSTAT])
         rdata = self.read_reg(reg_addr)
-        value = int.from_bytes(rdata, byteorder='little')
+        value = rdata[0]
         return value
 
 if __name__ == '__main__':
@@ -3,10 +3,19 @@
 import sys, os
 sys.path.append(os.pardir)
 from sc18im700 import SC18IM700
+from typing import Any, Iterator, Optional, Sequence
+from contextlib import contextmanager
+import asyncio
+import functools
 import time
 import logging
 
-logging.basicConfig(level=logging.DEBUG, format='%(levelname)s : %(module)s : %(funcName)s : %(message)s')
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 SHT30_I2C_ADDR = 0x44
 
@@ -16,10 +25,93 @@ HEATER_DISABLE      = [0x30, 0x66]
 READ_STATUS         = [0xF3, 0x2D]
 CLEAR_STATUS        = [0x30, 0x41]
 SINGLESHOT_MEASURE  = [0x2C, 0x06]
+SINGLESHOT_MEASURE_NO_STRETCH = [0x24, 0x00]
 PERIODIC_MEASURE    = [0x21, 0x30]
-READ_MEASURED_VALUE = [0x0E, 0x00]
+READ_MEASURED_VALUE = [0xE0, 0x00]
 STOP_MEASURE        = [0x30, 0x93]
 
+PERIODIC_MEASURE_MPS = {
+    0.5: [0x20, 0x32],
+    1:   [0x21, 0x30],
+    2:   [0x22, 0x36],
+    4:   [0x23, 0x34],
+    10:  [0x27, 0x37],
+}
+
+# 新しい測定値が未完成で NACK された取得は、シリアルのタイムアウト（115200bps では 50 ms）を待ち、
+# さらに周期のこの割合だけ待ってから一度だけ再試行する。10 mps では合計で周期の半分以上かかる
+PERIODIC_RETRY_RATIO = 0.1
+
+MEASURED_FRAME_SIZE = 6
+
+SOFT_RESET_WAIT = 5/1000
+COMMAND_WAIT    = 2/1000
+
+CRC8_POLYNOMIAL = 0x31
+
+def _make_crc8_table() -> bytes:
+    """ CRC8の参照テーブルを生成する
+    """
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ CRC8_POLYNOMIAL) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+_CRC8_TABLE = _make_crc8_table()
+
+def _parse_measured_frame(rdata: bytes) -> tuple[int, int]:
+    """ 6バイトの測定値フレームのCRCを検証し、温度と湿度の測定値を返す
+    """
+    t0, t1, crc_temp, h0, h1, crc_humi = rdata
+    if _CRC8_TABLE[_CRC8_TABLE[0xFF ^ t0] ^ t1] != crc_temp:
+        raise RuntimeError
+    if _CRC8_TABLE[_CRC8_TABLE[0xFF ^ h0] ^ h1] != crc_humi:
+        raise RuntimeError
+    return ((t0 << 8) | t1, (h0 << 8) | h1)
+
+_INV_RAW_MAX = 1.0 / (2**16 - 1)
+
+if np is not None:
+    _CRC8_TABLE_NP = np.frombuffer(_CRC8_TABLE, dtype=np.uint8)
+    _MEASURED_DTYPE = np.dtype([('temp', '>u2'), ('crc_temp', 'u1'), ('humi', '>u2'), ('crc_humi', 'u1')])
+
+def _find_crc8_mismatch(frames: Any, table: Any) -> int:
+    """ 測定値フレーム列のCRCを検証し、最初に不一致となったフレームの番号を返す（全て一致なら -1）
+    """
+    for i in range(frames.shape[0]):
+        for j in (0, 3):
+            crc = table[table[0xFF ^ frames[i, j]] ^ frames[i, j + 1]]
+            if crc != frames[i, j + 2]:
+                return i
+    return -1
+
+@functools.lru_cache(maxsize=None)
+def _jit_find_crc8_mismatch() -> Optional[Any]:
+    """ numba でコンパイルした _find_crc8_mismatch を返す（numba がなければ None）
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True)(_find_crc8_mismatch)
+
+_SOFT_RESET_FRAME = SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(SOFT_RESET))
+_HEATER_ENABLE_FRAME = SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(HEATER_ENABLE))
+_HEATER_DISABLE_FRAME = SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(HEATER_DISABLE))
+_CLEAR_STATUS_FRAME = SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(CLEAR_STATUS))
+_SINGLESHOT_MEASURE_NO_STRETCH_FRAME = SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(SINGLESHOT_MEASURE_NO_STRETCH))
+_READ_STATUS_FRAME = SC18IM700.i2c_write_read_frame(SHT30_I2C_ADDR, bytes(READ_STATUS), 3)
+_SINGLESHOT_MEASURE_FRAME = SC18IM700.i2c_write_read_frame(SHT30_I2C_ADDR, bytes(SINGLESHOT_MEASURE), 6)
+_READ_MEASURED_VALUE_FRAME = SC18IM700.i2c_write_read_frame(SHT30_I2C_ADDR, bytes(READ_MEASURED_VALUE), 6)
+_STOP_MEASURE_FRAME = SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(STOP_MEASURE))
+_PERIODIC_MEASURE_FRAMES = {mps: SC18IM700.i2c_write_frame(SHT30_I2C_ADDR, bytes(cmd)) for mps, cmd in PERIODIC_MEASURE_MPS.items()}
+
 class SHT30:
     """ 温湿度センサー（SHT30）の制御ドライバ """
 
@@ -27,6 +119,9 @@ class SHT30:
         """ インスタンスを初期化する
         """
         self.sc18: SC18IM700 = sc18
+        self._status_cache: Optional[int] = None
+        self._periodic_interval: Optional[float] = None
+        self._next_fetch: float = 0.0
 
     def begin(self) -> None:
         """ デバイスを開始する
@@ -34,143 +129,285 @@ class SHT30:
         self.soft_reset()
         self.heater_disable()
         self.clear_status()
-        if self.is_alerting:
+        status = self.read_status()
+        logger.debug('status: 0x%04X', status)
+        if status & 0x8000:
             raise RuntimeError
 
+    async def begin_async(self) -> None:
+        """ デバイスを開始する（待ち時間中はイベントループへ制御を返す）
+        """
+        await self.soft_reset_async()
+        await self.heater_disable_async()
+        await self.clear_status_async()
+        status = self.read_status()
+        logger.debug('status: 0x%04X', status)
+        if status & 0x8000:
+            raise RuntimeError
+
+    def _send_command(self, frame: bytes) -> None:
+        """ コマンドのフレームを送信し終えるまで待ち、ステータスのキャッシュを破棄する
+        """
+        self.sc18.write_raw(frame)
+        self.sc18.flush()
+        self._status_cache = None
+
     def soft_reset(self) -> None:
         """ デバイスをソフトリセットする
         """
-        wdata = bytes(SOFT_RESET)
-        self.sc18.write_i2c(SHT30_I2C_ADDR, wdata)
-        time.sleep(1)
+        self._send_command(_SOFT_RESET_FRAME)
+        time.sleep(SOFT_RESET_WAIT)
+
+    async def soft_reset_async(self) -> None:
+        """ デバイスをソフトリセットする（待ち時間中はイベントループへ制御を返す）
+        """
+        self._send_command(_SOFT_RESET_FRAME)
+        await asyncio.sleep(SOFT_RESET_WAIT)
 
     def heater_enable(self) -> None:
         """ 内臓ヒーターを稼働する
         """
-        wdata = bytes(HEATER_ENABLE)
-        self.sc18.write_i2c(SHT30_I2C_ADDR, wdata)
-        time.sleep(10/1000)
+        self._send_command(_HEATER_ENABLE_FRAME)
+        time.sleep(COMMAND_WAIT)
 
     def heater_disable(self) -> None:
         """ 内臓ヒーターを停止する
         """
-        wdata = bytes(HEATER_DISABLE)
-        self.sc18.write_i2c(SHT30_I2C_ADDR, wdata)
-        time.sleep(10/1000)
+        self._send_command(_HEATER_DISABLE_FRAME)
+        time.sleep(COMMAND_WAIT)
+
+    async def heater_disable_async(self) -> None:
+        """ 内臓ヒーターを停止する（待ち時間中はイベントループへ制御を返す）
+        """
+        self._send_command(_HEATER_DISABLE_FRAME)
+        await asyncio.sleep(COMMAND_WAIT)
 
     def read_status(self) -> int:
         """ ステータスを読み込む
         """
-        wdata = bytes(READ_STATUS)
-        self.sc18.write_i2c(SHT30_I2C_ADDR, wdata)
-        time.sleep(10/1000)
-        rdata = self.sc18.read_i2c(SHT30_I2C_ADDR, size=3)
-        crc = self.crc8(rdata[0:2])
-        if crc != rdata[2]:
+        rdata = self.sc18.write_read_raw(_READ_STATUS_FRAME, size=3)
+        s0, s1, crc = rdata
+        if _CRC8_TABLE[_CRC8_TABLE[0xFF ^ s0] ^ s1] != crc:
             raise RuntimeError
-        value = int.from_bytes(rdata[0:2], byteorder='big')
-        return value
+        return (s0 << 8) | s1
+
+    @contextmanager
+    def status_snapshot(self) -> Iterator[int]:
+        """ ステータスを一度だけ読み込み、ブロック内のフラグ参照で共有する（ブロックを抜けるかコマンドを送ると破棄する）
+        """
+        status = self.read_status()
+        self._status_cache = status
+        try:
+            yield status
+        finally:
+            self._status_cache = None
+
+    def _status(self) -> int:
+        """ キャッシュ済みのステータスを返す（未キャッシュなら読み込む）
+        """
+        if self._status_cache is None:
+            return self.read_status()
+        return self._status_cache
 
     def clear_status(self) -> None:
         """ ステータスをクリアする
         """
-        wdata = bytes(CLEAR_STATUS)
-        self.sc18.write_i2c(SHT30_I2C_ADDR, wdata)
-        time.sleep(10/1000)
+        self._send_command(_CLEAR_STATUS_FRAME)
+        time.sleep(COMMAND_WAIT)
+
+    async def clear_status_async(self) -> None:
+        """ ステータスをクリアする（待ち時間中はイベントループへ制御を返す）
+        """
+        self._send_command(_CLEAR_STATUS_FRAME)
+        await asyncio.sleep(COMMAND_WAIT)
 
     @property
     def is_alerting(self) -> bool:
         """ アラートが発信中のとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x8000)
 
     @property
     def heater_enabled(self) -> bool:
         """ 内臓ヒーターが稼働中のとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x2000)
 
     @property
     def is_humi_alerting(self) -> bool:
         """ 湿度アラームが発信中にとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x0800)
 
     @property
     def is_temp_alerting(self) -> bool:
         """ 温度アラームが発信中のとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x0400)
 
     @property
     def is_reset_detected(self) -> bool:
         """ リセット履歴があるとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x0010)
 
     @property
     def is_command_failed(self) -> bool:
         """ 最後に受信したコマンドがエラーのとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x0002)
 
     @property
     def is_write_crc_error(self) -> bool:
         """ 最後に受信した電文のCRCが不一致のとき True を返す
         """
-        status = self.read_status()
+        status = self._status()
         return bool(status & 0x0001)
 
     def singleshot_measure(self) -> tuple[int, int]:
         """ 温度と湿度を単発測定する
         """
-        wdata = bytes(SINGLESHOT_MEASURE)
-        self.sc18.write_i2c(SHT30_I2C_ADDR, wdata)
-        time.sleep(30/1000)
+        rdata = self.sc18.write_read_raw(_SINGLESHOT_MEASURE_FRAME, size=6)
+        return _parse_measured_frame(rdata)
+
+    async def singleshot_measure_async(self) -> tuple[int, int]:
+        """ 温度と湿度を単発測定する（測定中はイベントループへ制御を返す）
+        """
+        self.sc18.write_raw(_SINGLESHOT_MEASURE_NO_STRETCH_FRAME)
+        self.sc18.flush()
+        await asyncio.sleep(30/1000)
         rdata = self.sc18.read_i2c(SHT30_I2C_ADDR, size=6)
-        crc_temp = self.crc8(rdata[0:2])
-        crc_humi = self.crc8(rdata[3:5])
-        if (crc_temp != rdata[2]) or (crc_humi != rdata[5]):
+        return _parse_measured_frame(rdata)
+
+    def start_periodic(self, mps: float = 10) -> None:
+        """ 周期測定を開始する（mps: 1秒あたりの測定回数）
+        """
+        if mps not in _PERIODIC_MEASURE_FRAMES:
+            raise ValueError
+        self.sc18.write_raw(_PERIODIC_MEASURE_FRAMES[mps])
+        self.sc18.flush()
+        self._periodic_interval = 1 / mps
+        self._next_fetch = time.monotonic() + self._periodic_interval
+
+    def stop_periodic(self) -> None:
+        """ 周期測定を停止する
+        """
+        self.sc18.write_raw(_STOP_MEASURE_FRAME)
+        self.sc18.flush()
+        self._periodic_interval = None
+        time.sleep(COMMAND_WAIT)
+
+    def _fetch_periodic_frame(self) -> memoryview:
+        """ 次の測定値が揃う時刻まで待ってから、周期測定の測定値フレームを読み込む
+        """
+        if self._periodic_interval is None:
             raise RuntimeError
-        raw_temp = int.from_bytes(rdata[0:2], byteorder='big')
-        raw_humi = int.from_bytes(rdata[3:5], byteorder='big')
-        return (raw_temp, raw_humi)
+        delay = self._next_fetch - time.monotonic()
+        if 0 < delay:
+            time.sleep(delay)
+        try:
+            rdata = self.sc18.write_read_raw(_READ_MEASURED_VALUE_FRAME, size=6)
+        except RuntimeError:
+            # センサーのクロック誤差で新しい測定値が未完成のときは NACK されるため、少し待って一度だけ再試行する
+            time.sleep(self._periodic_interval * PERIODIC_RETRY_RATIO)
+            rdata = self.sc18.write_read_raw(_READ_MEASURED_VALUE_FRAME, size=6)
+        self._next_fetch = time.monotonic() + self._periodic_interval
+        return rdata
+
+    def fetch_periodic(self) -> tuple[int, int]:
+        """ 周期測定の次の温度と湿度を読み込む
+        """
+        rdata = self._fetch_periodic_frame()
+        return _parse_measured_frame(rdata)
+
+    def read_periodic(self, n: int) -> tuple[Any, Any]:
+        """ 周期測定の温度と湿度をn回分読み込み、まとめて検証・変換する（numba があると初回のみコンパイルに約0.4秒かかる）
+        """
+        if n < 1:
+            raise ValueError
+        rdata = bytearray()
+        for _ in range(n):
+            rdata += self._fetch_periodic_frame()
+        return self.parse_measured_values(bytes(rdata))
+
+    @staticmethod
+    def parse_measured_values(rdata: bytes) -> tuple[Any, Any]:
+        """ 測定値フレームの列からCRCを検証し、温度と湿度の測定値を返す（NumPyがあれば配列で返す、numba があると初回のみコンパイルに約0.4秒かかる）
+        """
+        if len(rdata) % MEASURED_FRAME_SIZE:
+            raise ValueError
+        if np is None:
+            raw_temps = []
+            raw_humis = []
+            view = memoryview(rdata)
+            for offset in range(0, len(rdata), MEASURED_FRAME_SIZE):
+                raw_temp, raw_humi = _parse_measured_frame(view[offset:offset + MEASURED_FRAME_SIZE])
+                raw_temps.append(raw_temp)
+                raw_humis.append(raw_humi)
+            return (raw_temps, raw_humis)
+        frames = np.frombuffer(rdata, dtype=np.uint8).reshape(-1, MEASURED_FRAME_SIZE)
+        find_crc8_mismatch = _jit_find_crc8_mismatch()
+        if find_crc8_mismatch is not None:
+            if find_crc8_mismatch(frames, _CRC8_TABLE_NP) >= 0:
+                raise RuntimeError
+        else:
+            crc_temp = _CRC8_TABLE_NP[_CRC8_TABLE_NP[0xFF ^ frames[:, 0]] ^ frames[:, 1]]
+            crc_humi = _CRC8_TABLE_NP[_CRC8_TABLE_NP[0xFF ^ frames[:, 3]] ^ frames[:, 4]]
+            if np.any(crc_temp != frames[:, 2]) or np.any(crc_humi != frames[:, 5]):
+                raise RuntimeError
+        values = np.frombuffer(rdata, dtype=_MEASURED_DTYPE)
+        return (values['temp'].astype(np.uint16), values['humi'].astype(np.uint16))
 
     def temperature_C(self, raw_temp: int) -> float:
         """ 摂氏温度を返す
         """
-        return float(-45 + 175 * (raw_temp / (2**16 - 1)))
+        return -45.0 + 175.0 * raw_temp * _INV_RAW_MAX
 
     def temperature_F(self, raw_temp: int) -> float:
         """ 華氏温度を返す
         """
-        return float(-49 + 315 * (raw_temp / (2**16 - 1)))
+        return -49.0 + 315.0 * raw_temp * _INV_RAW_MAX
 
     def relative_humidity(self, raw_humi: int) -> float:
         """ 相対湿度を返す
         """
-        return float(100 * (raw_humi / (2**16 - 1)))
+        return 100.0 * raw_humi * _INV_RAW_MAX
+
+    def temperature_C_batch(self, raw_temps: Sequence[int]) -> Any:
+        """ 複数の測定値から摂氏温度をまとめて返す（NumPyがあれば配列で返す）
+        """
+        if np is None:
+            return [self.temperature_C(raw) for raw in raw_temps]
+        return -45.0 + 175.0 * (np.asarray(raw_temps, dtype=np.float64) * _INV_RAW_MAX)
+
+    def temperature_F_batch(self, raw_temps: Sequence[int]) -> Any:
+        """ 複数の測定値から華氏温度をまとめて返す（NumPyがあれば配列で返す）
+        """
+        if np is None:
+            return [self.temperature_F(raw) for raw in raw_temps]
+        return -49.0 + 315.0 * (np.asarray(raw_temps, dtype=np.float64) * _INV_RAW_MAX)
+
+    def relative_humidity_batch(self, raw_humis: Sequence[int]) -> Any:
+        """ 複数の測定値から相対湿度をまとめて返す（NumPyがあれば配列で返す）
+        """
+        if np is None:
+            return [self.relative_humidity(raw) for raw in raw_humis]
+        return 100.0 * (np.asarray(raw_humis, dtype=np.float64) * _INV_RAW_MAX)
 
-    def crc8(self, data: bytes) ->  int:
+    @staticmethod
+    def crc8(data: bytes) -> int:
         """ CRCを返す
         """
-        POLYNOMIAL = 0x31
         crc = 0xFF
         for d in data:
-            crc ^= d
-            for _ in range(8):
-                if crc & 0x80:
-                    crc <<= 1
-                    crc ^= POLYNOMIAL
-                else:
-                    crc <<= 1
-        return int(crc & 0xFF)
+            crc = _CRC8_TABLE[crc ^ d]
+        return crc
 
 if __name__ == '__main__':
     pass
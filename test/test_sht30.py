@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import unittest
+from unittest import mock
+import sht30.sht30 as sht30_module
+import sc18im700.sc18im700 as sc18im700_module
+from sc18im700 import SC18IM700
+from sht30 import SHT30
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+RAW_VALUES = [(0x0000, 0xFFFF), (0xBEEF, 0x6666), (0x1234, 0xABCD), (0xFFFF, 0x0000)]
+
+def make_frames(values: list) -> bytes:
+    """ 測定値の組から測定値フレームの列を生成する
+    """
+    rdata = bytearray()
+    for raw_temp, raw_humi in values:
+        for raw in (raw_temp, raw_humi):
+            word = raw.to_bytes(2, byteorder='big')
+            rdata += word + bytes([SHT30.crc8(word)])
+    return bytes(rdata)
+
+class FakeSerial:
+    """ 書き込みごとに用意した応答を返す serial.Serial の代用品 """
+
+    def __init__(self, port, responses: list) -> None:
+        self.port = port
+        self.is_open = True
+        self.baudrate = None
+        self.bytesize = None
+        self.parity = None
+        self.stopbits = None
+        self.timeout = None
+        self.inter_byte_timeout = None
+        self.responses = list(responses)
+        self.tx = bytearray()
+        self.rx = bytearray()
+        self.writes = []
+
+    def reset_input_buffer(self) -> None:
+        self.rx.clear()
+
+    def reset_output_buffer(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        self.tx += data
+        self.writes.append(bytes(data))
+        if self.responses:
+            self.rx += self.responses.pop(0)
+        return len(data)
+
+    def read(self, size: int) -> bytes:
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.is_open = False
+
+class FakeClock:
+    """ time.monotonic と time.sleep の代用品 """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def make_sc18(responses: list) -> SC18IM700:
+    """ FakeSerial に接続した SC18IM700 を返す（ボーレートの問い合わせには 115200 を応答する）
+    """
+    brg = SC18IM700.baudrate_to_brg(115200).to_bytes(2, byteorder='little')
+    factory = lambda port: FakeSerial(port, [brg] + responses)
+    with mock.patch.object(sc18im700_module.serial, 'Serial', factory):
+        return SC18IM700('FAKE')
+
+def as_lists(values: tuple) -> tuple:
+    """ 測定値を比較用の int のリストに変換する
+    """
+    return tuple([int(v) for v in seq] for seq in values)
+
+class TestCrc8(unittest.TestCase):
+
+    def test_datasheet_vector(self):
+        self.assertEqual(SHT30.crc8(bytes([0xBE, 0xEF])), 0x92)
+
+class TestParseMeasuredValues(unittest.TestCase):
+
+    def backends(self) -> list:
+        """ 利用可能な検証処理ごとのパッチを返す
+        """
+        backends = [('python', mock.patch.object(sht30_module, 'np', None))]
+        if sht30_module.np is not None:
+            backends.append(('numpy', mock.patch.object(sht30_module, '_jit_find_crc8_mismatch', lambda: None)))
+            if numba is not None:
+                backends.append(('numba', mock.patch.object(sht30_module, '_jit_find_crc8_mismatch', sht30_module._jit_find_crc8_mismatch)))
+        return backends
+
+    def test_backends_agree(self):
+        rdata = make_frames(RAW_VALUES)
+        expected = ([t for t, _ in RAW_VALUES], [h for _, h in RAW_VALUES])
+        for name, patch in self.backends():
+            with self.subTest(backend=name), patch:
+                self.assertEqual(as_lists(SHT30.parse_measured_values(rdata)), expected)
+
+    def test_backends_reject_corrupted_crc(self):
+        rdata = make_frames(RAW_VALUES)
+        for name, patch in self.backends():
+            for index in (2, 5):
+                corrupted = bytearray(rdata)
+                corrupted[6 + index] ^= 0x01
+                with self.subTest(backend=name, index=index), patch:
+                    with self.assertRaises(RuntimeError):
+                        SHT30.parse_measured_values(bytes(corrupted))
+
+    def test_rejects_partial_frame(self):
+        with self.assertRaises(ValueError):
+            SHT30.parse_measured_values(make_frames(RAW_VALUES)[:-1])
+
+class TestStatusSnapshot(unittest.TestCase):
+
+    def status_frame(self, status: int) -> bytes:
+        """ ステータスの応答フレームを返す
+        """
+        word = status.to_bytes(2, byteorder='big')
+        return word + bytes([SHT30.crc8(word)])
+
+    def status_reads(self, sc18: SC18IM700) -> int:
+        """ 書き込まれたステータス読み込みフレームの数を返す
+        """
+        return sc18.serial.writes.count(sht30_module._READ_STATUS_FRAME)
+
+    def test_flags_share_one_read(self):
+        sc18 = make_sc18([self.status_frame(0x8010)])
+        sht30 = SHT30(sc18)
+        with sht30.status_snapshot() as status:
+            self.assertEqual(status, 0x8010)
+            self.assertTrue(sht30.is_alerting)
+            self.assertTrue(sht30.is_reset_detected)
+            self.assertFalse(sht30.heater_enabled)
+        self.assertEqual(self.status_reads(sc18), 1)
+
+    def test_flags_read_again_after_snapshot(self):
+        sc18 = make_sc18([self.status_frame(0x8000), self.status_frame(0x0000)])
+        sht30 = SHT30(sc18)
+        with sht30.status_snapshot():
+            self.assertTrue(sht30.is_alerting)
+        self.assertFalse(sht30.is_alerting)
+        self.assertEqual(self.status_reads(sc18), 2)
+
+class TestPeriodicMeasure(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(sht30_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_frames(self, sc18: SC18IM700) -> list:
+        """ 書き込まれた測定値取得フレームを返す
+        """
+        return [w for w in sc18.serial.writes if w == sht30_module._READ_MEASURED_VALUE_FRAME]
+
+    def test_read_measured_value_frame(self):
+        self.assertEqual(sht30_module._READ_MEASURED_VALUE_FRAME, b'S\x88\x02\xe0\x00S\x89\x06P')
+
+    def test_fetch_is_paced_by_period(self):
+        frames = [make_frames([values]) for values in RAW_VALUES[:2]]
+        sc18 = make_sc18([b''] + frames)
+        sht30 = SHT30(sc18)
+        sht30.start_periodic(mps=10)
+        self.assertEqual(sht30.fetch_periodic(), RAW_VALUES[0])
+        self.assertEqual(sht30.fetch_periodic(), RAW_VALUES[1])
+        self.assertEqual(len(self.fetch_frames(sc18)), 2)
+        self.assertEqual(len(self.clock.sleeps), 2)
+        for seconds in self.clock.sleeps:
+            self.assertAlmostEqual(seconds, 0.1)
+
+    def test_fetch_retries_once_after_nack(self):
+        sc18 = make_sc18([b'', b'', make_frames([RAW_VALUES[1]])])
+        sht30 = SHT30(sc18)
+        sht30.start_periodic(mps=10)
+        self.assertEqual(sht30.fetch_periodic(), RAW_VALUES[1])
+        self.assertEqual(len(self.fetch_frames(sc18)), 2)
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertAlmostEqual(self.clock.sleeps[1], 0.1 * sht30_module.PERIODIC_RETRY_RATIO)
+
+    def test_fetch_fails_after_second_nack(self):
+        sc18 = make_sc18([b'', b'', b''])
+        sht30 = SHT30(sc18)
+        sht30.start_periodic(mps=10)
+        with self.assertRaises(RuntimeError):
+            sht30.fetch_periodic()
+        self.assertEqual(len(self.fetch_frames(sc18)), 2)
+
+if __name__ == '__main__':
+    unittest.main()